@@ -0,0 +1,142 @@
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class SamplingProfiler:
+    """Samples the profiled thread's stack from a background thread.
+
+    Much cheaper than cProfile for hot loops since nothing runs on each call,
+    only once per interval.
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return [f"{stack} {count}" for stack, count in self.counts.items()]
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def cprofile_collapsed(profile):
+    """Collapsed stacks from cProfile, weighted by own time in microseconds.
+
+    cProfile only records caller -> callee edges, so stacks are two frames
+    deep: enough to see which call sites the time is spent under.
+    """
+    lines = []
+    for (filename, line, name), (_, _, tottime, _, callers) in pstats.Stats(profile).stats.items():
+        callee = f"{name} ({os.path.basename(filename)}:{line})"
+        if not callers:
+            lines.append(f"{callee} {int(tottime * 1e6)}")
+        for (caller_file, caller_line, caller_name), edge in callers.items():
+            caller = f"{caller_name} ({os.path.basename(caller_file)}:{caller_line})"
+            lines.append(f"{caller};{callee} {int(edge[2] * 1e6)}")
+    return lines
+
+
+class Profiler:
+    """Profiles one sender or receiver run.
+
+    mode is "cprofile" or "sample". Besides the collapsed stacks, records wall
+    and CPU time per phase (see phase()) and, with trace_memory, tracemalloc
+    snapshots when the handshake and teardown phases start. stop() writes the
+    results to files named prefix + suffix and returns their paths.
+    """
+
+    def __init__(self, mode, prefix, trace_memory=False):
+        self.mode = mode
+        self.prefix = prefix
+        self.trace_memory = trace_memory
+        self.phases = []  # (name, wall seconds, cpu seconds)
+        self.current = None  # (name, wall start, cpu start)
+        self.snapshots = []  # (phase name, tracemalloc snapshot)
+        if mode == "cprofile":
+            self.profile = cProfile.Profile()
+        else:
+            self.profile = SamplingProfiler()
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.mode == "cprofile":
+            self.profile.enable()
+        else:
+            self.profile.start()
+
+    def phase(self, name):
+        """End the current phase (if any) and start timing the next one"""
+        now = (time.perf_counter(), time.process_time())
+        if self.current is not None:
+            phase, wall, cpu = self.current
+            self.phases.append((phase, now[0] - wall, now[1] - cpu))
+        self.current = (name, *now)
+        if self.trace_memory and name in ("handshake", "teardown"):
+            self.snapshots.append((name, tracemalloc.take_snapshot()))
+
+    def stop(self):
+        if self.current is not None:
+            self.phase(None)
+            self.current = None
+        if self.mode == "cprofile":
+            self.profile.disable()
+            lines = cprofile_collapsed(self.profile)
+        else:
+            self.profile.stop()
+            lines = self.profile.collapsed()
+
+        paths = [self.prefix + ".collapsed", self.prefix + ".phases.txt"]
+        with open(paths[0], "w") as f:
+            f.write("\n".join(lines) + "\n")
+        with open(paths[1], "w") as f:
+            f.write("phase wall_s cpu_s\n")
+            for name, wall, cpu in self.phases:
+                f.write(f"{name} {wall:.6f} {cpu:.6f}\n")
+        if self.mode == "cprofile":
+            paths.append(self.prefix + ".prof")
+            self.profile.dump_stats(paths[-1])
+        if self.trace_memory:
+            paths.append(self.prefix + ".tracemalloc.txt")
+            self.write_snapshots(paths[-1])
+            tracemalloc.stop()
+        return paths
+
+    def write_snapshots(self, path):
+        with open(path, "w") as f:
+            for name, snapshot in self.snapshots:
+                f.write(f"--- top allocations at {name}\n")
+                for stat in snapshot.statistics("lineno")[:20]:
+                    f.write(f"{stat}\n")
+            if len(self.snapshots) == 2:
+                f.write(f"--- growth from {self.snapshots[0][0]} to {self.snapshots[1][0]}\n")
+                for stat in self.snapshots[1][1].compare_to(self.snapshots[0][1], "lineno")[:20]:
+                    f.write(f"{stat}\n")
@@ -1,77 +1,266 @@
+import argparse
 import socket
+import struct
 import sys
+import time
 
 from util import *
 
 
-def receiver(receiver_port, window_size):
-    """Listen on socket and print received message to sys.stdout"""
+def receiver(
+    receiver_port,
+    window_size,
+    packet_size=DEFAULT_PACKET_SIZE,
+    output_path=None,
+    resume=False,
+    profiler=None,
+):
+    """Listen on socket and write received message to output_path, or sys.stdout if not given"""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.bind(("127.0.0.1", receiver_port))
     print_debug(f"Receiver bound to port {receiver_port}, window size: {window_size}")
 
+    # One receive buffer sized for the largest packet we accept, reused for every packet.
+    # It must also fit a START with all options, whatever packet size we accept.
+    packet_size = min(packet_size, MAX_PACKET_SIZE)
+    recv_buffer = bytearray(max(packet_size, HEADER_SIZE + START_OPTIONS_SIZE))
+    recv_view = memoryview(recv_buffer)
+
     s.settimeout(30)
 
+    if profiler:
+        profiler.phase("handshake")
+
     # Initialize
     expected_seq_num = 1  # First data packet should have seq_num=1
     received_data = {}  # Buffer for out-of-order packets
     connection_active = False
     sender_address = True
+    fec_block = 0  # DATA packets per PARITY packet, negotiated at START
+    fec_blocks = {}  # First seq_num of block -> {"data": {seq_num: msg}, "parity": payload}
+    checkpoint_time = 0  # Last time the resume checkpoint was saved
+    # Where in-order data goes, wrapped in a StreamDecoder if compression is negotiated
+    if output_path is not None and not resume:
+        sink = open(output_path, "wb")
+    else:
+        sink = sys.stdout.buffer
+    output = sink
+    checkpoint = None  # Resumable transfers write to output_path through a Checkpoint
+    end_status = END_OK  # Verdict on a resumable transfer, sent with the END ACK
+
+    def handle_data(seq_num, msg):
+        """Deliver or buffer a DATA payload, return False if it is outside the window"""
+        nonlocal expected_seq_num
+
+        if checkpoint is not None and seq_num < expected_seq_num + window_size:
+            # Packets go straight to their place in the file, in or out of order
+            checkpoint.write(seq_num, msg)
+            expected_seq_num = checkpoint.expected_seq_num
+        # Check if packet is duplicated (already processed)
+        elif seq_num < expected_seq_num:
+            print_debug(f"Duplicate DATA packet {seq_num} ignored")
+        elif seq_num == expected_seq_num:
+            output.write(msg)
+            output.flush()
+            expected_seq_num += 1
+            # Processs any buffered next packets in order
+            while expected_seq_num in received_data:
+                output.write(received_data[expected_seq_num])
+                output.flush()
+                del received_data[expected_seq_num]
+                expected_seq_num += 1
+        elif seq_num >= expected_seq_num + window_size:
+            print_debug(f"Dropped packet {seq_num} outside window")
+            return False
+        else:
+            # For out-of-order, only buffer if not already
+            if seq_num not in received_data:
+                received_data[seq_num] = msg
+        return True
+
+    def window_edge():
+        """First seq_num we can't accept, advertised in every ACK.
+
+        Measured from the cumulative point, packets buffered past a hole
+        don't shrink it.
+        """
+        return expected_seq_num + window_size
+
+    def fec_recover(block_start):
+        """Rebuild the missing packet of a block if only one is missing, or return None"""
+        block = fec_blocks[block_start]
+        if block["parity"] is None:
+            return None
+        count = struct.unpack_from(PARITY_FORMAT, block["parity"])[0]
+        if len(block["data"]) != count - 1:
+            return None
+        for seq_num in range(block_start, block_start + count):
+            if seq_num not in block["data"]:
+                msg = recover_chunk(block["parity"], block["data"].values())
+                block["data"][seq_num] = msg
+                return seq_num, msg
 
     try:
         while True:
             try:
                 # Receive packet
-                pkt, address = s.recvfrom(1472)
+                nbytes, address = s.recvfrom_into(recv_buffer)
+                pkt = recv_view[:nbytes]
+                if nbytes < HEADER_SIZE:
+                    print_debug(f"Ignoring {nbytes} byte datagram, too short for a header")
+                    continue
 
                 # Extract header
-                pkt_header = PacketHeader(pkt[:16])
+                pkt_header = parse_header(pkt)
 
-                # Verify checksum
-                original_checksum = pkt_header.checksum
-                pkt_header.checksum = 0
-
-                # Reconstruct packet for checksum verification
-                if pkt_header.length > 0:
-                    msg = pkt[16 : 16 + pkt_header.length]
-                    computed_checksum = compute_checksum(bytes(pkt_header) + msg)
-                else:
-                    # FOr control packets with no data
-                    computed_checksum = compute_checksum(bytes(pkt_header))
+                # Payload (empty for most control packets)
+                msg = bytes(pkt[HEADER_SIZE : HEADER_SIZE + pkt_header.length])
 
                 # Check if checksum is valid
-                if original_checksum != computed_checksum:
+                if pkt_header.checksum != packet_checksum(pkt, msg):
                     print_debug(
                         f"Checksum error in packet {pkt_header.seq_num}, ignoring",
                     )
                     continue
 
+                # Late packets of an earlier connection (e.g. from a sender that was
+                # restarted) may arrive before START, there is nobody to answer yet
+                if pkt_header.type != 0 and not connection_active:
+                    print_debug(f"Ignoring packet {pkt_header.seq_num} of type {pkt_header.type} before START")
+                    continue
+
                 # Handle packet based ob type
                 if pkt_header.type == 0:  # START
                     print_debug(f"Received START packet from {address}")
 
-                    # Set the expected sequence number for the first data packet
-                    expected_seq_num = 1
+                    # Answer with the packet size we accept
+                    proposed = unpack_options(msg)
+                    accepted = min(proposed["packet_size"], packet_size)
+                    proposed_fec = proposed["fec_block"]
+                    if data_size(accepted, proposed_fec) <= 0:
+                        # Too small for data next to the PARITY fields, turn FEC off
+                        proposed_fec = 0
+                    # Same message in packets of the same size as the checkpointed transfer
+                    restarted = checkpoint is not None and (
+                        proposed["message_size"],
+                        proposed["message_crc"],
+                        data_size(accepted, proposed_fec),
+                    ) == (checkpoint.message_size, checkpoint.message_crc, checkpoint.data_size)
+
                     if not connection_active:
                         connection_active = True
                         sender_address = address
                         print(f"Connection activated with sender {sender_address}", file=sys.stderr)
-                        
-                        # Send ACK for START
-                        ack_packet = create_ack(1)
+
+                        # Send ACK for START with the options we accept
+                        fec_block = proposed_fec
+                        codec = proposed["codec"] if proposed["codec"] in CODECS else 0
+
+                        # Set the expected sequence number for the first data packet
+                        expected_seq_num = 1
+                        if resume and proposed["message_size"]:
+                            # Continue where a previous transfer of this message stopped.
+                            # Sequence numbers map to file offsets, so no compression.
+                            codec = 0
+                            checkpoint = Checkpoint.open(
+                                output_path,
+                                proposed["message_size"],
+                                proposed["message_crc"],
+                                data_size(accepted, fec_block),
+                                window_size,
+                            )
+                            expected_seq_num = checkpoint.expected_seq_num
+                            print_debug(f"Resuming transfer at packet {expected_seq_num}")
+                        elif resume:
+                            print_debug("Sender did not identify the message, cannot resume")
+                            sink = open(output_path, "wb")
+                            output = sink
+
+                        if codec:
+                            output = StreamDecoder(sink, codec)
+                        ack_packet = create_ack(
+                            1,
+                            data=pack_options(
+                                packet_size=accepted,
+                                fec_block=fec_block,
+                                codec=codec,
+                                message_size=proposed["message_size"],
+                                message_crc=proposed["message_crc"],
+                                resume_seq=expected_seq_num,
+                                receiver_window=window_size,
+                            ),
+                        )
+                        print_debug(
+                            f"Accepted packet size {accepted}, FEC block {fec_block}, codec {codec}"
+                        )
+
+                        # Size kernel buffers to hold a full window of packets
+                        granted = tune_socket_buffers(s, window_size * accepted)
+                        print_debug(
+                            f"Socket buffers granted: receive {granted[0]}, send {granted[1]} bytes"
+                        )
 
                         s.sendto(ack_packet, address)
                         print_debug(f"Sent ACK for START to {sender_address}")
+                        if profiler:
+                            profiler.phase("transfer")
+
+                    elif restarted:
+                        # A sender that died and restarted comes from a new port,
+                        # continue the transfer with it from the last packet written
+                        checkpoint.save()
+                        checkpoint_time = time.time()
+                        if address != sender_address:
+                            print(
+                                f"Sender restarted as {address}, resuming at packet "
+                                f"{checkpoint.expected_seq_num}",
+                                file=sys.stderr,
+                            )
+                        sender_address = address
+                        fec_block = proposed_fec
+                        fec_blocks = {}
+                        ack_packet = create_ack(
+                            1,
+                            data=pack_options(
+                                packet_size=accepted,
+                                fec_block=fec_block,
+                                message_size=checkpoint.message_size,
+                                message_crc=checkpoint.message_crc,
+                                resume_seq=checkpoint.expected_seq_num,
+                                receiver_window=window_size,
+                            ),
+                        )
+                        s.sendto(ack_packet, address)
+                        print_debug(f"Sent ACK for START to {sender_address}")
 
                     else:
                         print_debug(f"Ignored START from {address} while in connection with {sender_address}")
 
                 elif pkt_header.type == 1:  # End
+                    if profiler:
+                        profiler.phase("teardown")
                     print_debug(
                         f"Received END packet with seq_num {pkt_header.seq_num}",
                     )
-                    # Send ACK for END
-                    ack_packet = create_ack(pkt_header.seq_num + 1)
+                    if checkpoint is not None:
+                        complete = checkpoint.complete()
+                        if checkpoint.finish():
+                            print_debug("Message CRC verified, checkpoint removed")
+                        elif complete:
+                            end_status = END_CRC_MISMATCH
+                            print("Message CRC mismatch, output and checkpoint discarded", file=sys.stderr)
+                        else:
+                            end_status = END_INCOMPLETE
+                            print("Message incomplete, checkpoint kept", file=sys.stderr)
+                        checkpoint = None
+
+                    # Send ACK for END, telling the sender if the message did not verify
+                    if end_status == END_OK:
+                        ack_packet = create_ack(pkt_header.seq_num + 1)
+                    else:
+                        ack_packet = create_ack(
+                            pkt_header.seq_num + 1, data=struct.pack(END_STATUS_FORMAT, end_status)
+                        )
 
                     s.sendto(ack_packet, sender_address)
                     print_debug("Sent ACK for END, terminating conneciton")
@@ -79,40 +268,50 @@ def receiver(receiver_port, window_size):
                     connection_active = False
                     break
                 elif pkt_header.type == 2:  # DATA
-                    msg = pkt[16 : 16 + pkt_header.length]
                     print_debug(
                         f"Received DATA packet {pkt_header.seq_num}, size: {pkt_header.length}",
                     )
 
-                    # Check if packet is duplicated (already processed)
-                    if pkt_header.seq_num < expected_seq_num:
-                        print_debug(
-                            f"Duplicate DATA packet {pkt_header.seq_num} ignored",
-                        )
-                    elif pkt_header.seq_num == expected_seq_num:
-                        sys.stdout.buffer.write(msg)
-                        sys.stdout.flush()
-                        expected_seq_num += 1
-                        # Processs any buffered next packets in order
-                        while expected_seq_num in received_data:
-                            sys.stdout.buffer.write(received_data[expected_seq_num])
-                            sys.stdout.flush()
-                            del received_data[expected_seq_num]
-                            expected_seq_num += 1
-                    elif pkt_header.seq_num >= expected_seq_num + window_size:
-                        print_debug(
-                            f"Dropped packet {pkt_header.seq_num} outside window"
-                        )
+                    if not handle_data(pkt_header.seq_num, msg):
                         continue
-                    else:
-                        # For out-of-order, only buffer if not already
-                        if pkt_header.seq_num not in received_data:
-                            received_data[pkt_header.seq_num] = msg
 
-                    ack_packet = create_ack(pkt_header.seq_num)
+                    # Advertise the right edge of our window
+                    ack_packet = create_ack(pkt_header.seq_num, window=window_edge())
                     s.sendto(ack_packet, sender_address)
                     print_debug(f"Sent indiviual ACK for packet {pkt_header.seq_num}")
 
+                    # Keep the payload for FEC until its whole block is delivered
+                    if fec_block:
+                        block_start = pkt_header.seq_num - (pkt_header.seq_num - 1) % fec_block
+                        if block_start + fec_block > expected_seq_num:
+                            block = fec_blocks.setdefault(block_start, {"data": {}, "parity": None})
+                            block["data"][pkt_header.seq_num] = msg
+                elif pkt_header.type == 4 and fec_block:  # PARITY
+                    print_debug(f"Received PARITY packet for block {pkt_header.seq_num}")
+                    block_start = pkt_header.seq_num
+                    if block_start + fec_block > expected_seq_num:
+                        block = fec_blocks.setdefault(block_start, {"data": {}, "parity": None})
+                        block["parity"] = msg
+                else:
+                    continue
+
+                if fec_block:
+                    # A DATA or PARITY packet may complete a block missing one packet,
+                    # rebuild it and ACK it as if it had been received
+                    block_start = pkt_header.seq_num - (pkt_header.seq_num - 1) % fec_block
+                    recovered = fec_recover(block_start) if block_start in fec_blocks else None
+                    if recovered and handle_data(*recovered):
+                        s.sendto(create_ack(recovered[0], window=window_edge()), sender_address)
+                        print_debug(f"Recovered DATA packet {recovered[0]} from parity, sent ACK")
+
+                    # Forget blocks that have been delivered completely
+                    for block_start in [b for b in fec_blocks if b + fec_block <= expected_seq_num]:
+                        del fec_blocks[block_start]
+
+                if checkpoint is not None and time.time() - checkpoint_time > CHECKPOINT_INTERVAL:
+                    checkpoint.save()
+                    checkpoint_time = time.time()
+
             except socket.timeout:
                 if not connection_active:
                     print_debug("Socket timeout while waiting for initial conneciton")
@@ -125,15 +324,73 @@ def receiver(receiver_port, window_size):
     finally:
         s.close()
         print_debug("Receiver socket closed")
+        if checkpoint is not None:
+            # Interrupted transfer, save progress for the next run
+            checkpoint.close()
+            print_debug(f"Saved checkpoint at packet {checkpoint.expected_seq_num}")
+        if sink is not sys.stdout.buffer:
+            sink.close()
+    return end_status == END_OK
 
 
 def main():
     """Parse command-line argument and call receiver function"""
-    if len(sys.argv) != 3:
-        sys.exit("Usage: python receiver.py [Receiver Port] [Window Size]")
-    receiver_port = int(sys.argv[1])
-    window_size = int(sys.argv[2])
-    receiver(receiver_port, window_size)
+    parser = argparse.ArgumentParser(
+        usage="python receiver.py [Receiver Port] [Window Size] [options] [--output PATH | > message]"
+    )
+    parser.add_argument("receiver_port", type=int)
+    parser.add_argument("window_size", type=int)
+    parser.add_argument(
+        "--packet-size",
+        type=int,
+        default=DEFAULT_PACKET_SIZE,
+        help="largest packet (header + data) to accept, e.g. 65507 on loopback",
+    )
+    parser.add_argument("-o", "--output", help="write the message to this file instead of stdout")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="checkpoint progress next to --output and continue interrupted transfers",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sample"],
+        help="profile the run and write collapsed stacks and phase timings next to the output file",
+    )
+    parser.add_argument(
+        "--trace-malloc",
+        action="store_true",
+        help="with --profile, also record tracemalloc snapshots at START and END",
+    )
+    args = parser.parse_args()
+    if args.packet_size <= HEADER_SIZE:
+        parser.error(f"--packet-size must be larger than the {HEADER_SIZE} byte header")
+    if args.resume and args.output is None:
+        parser.error("--resume needs --output")
+    profiler = None
+    if args.profile:
+        # Only load the profilers when asked for
+        from profiling import Profiler
+
+        profiler = Profiler(
+            args.profile, (args.output or "rtp") + ".receiver", trace_memory=args.trace_malloc
+        )
+        profiler.start()
+    try:
+        verified = receiver(
+            args.receiver_port,
+            args.window_size,
+            packet_size=args.packet_size,
+            output_path=args.output,
+            resume=args.resume,
+            profiler=profiler,
+        )
+    finally:
+        if profiler is not None:
+            for path in profiler.stop():
+                print_debug(f"Wrote profile output {path}")
+    if not verified:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,30 +1,83 @@
+import argparse
+import mmap
 import sys
 import socket
+import struct
 import time
+import zlib
 from util import *
 
 
-def sender(receiver_ip, receiver_port, window_size):
-    """Open socket and send message from sys.stdin"""
+def sender(
+    receiver_ip,
+    receiver_port,
+    window_size,
+    packet_size=DEFAULT_PACKET_SIZE,
+    probe_mtu=False,
+    fec_block=0,
+    message_path=None,
+    codec=0,
+    bandwidth=0,
+    resume=False,
+    profiler=None,
+):
+    """Open socket and send message from message_path, or sys.stdin if not given"""
     # Create UDP socket (SOCK_DGRAM) with IPv4 address family (AF_INET)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-    # Read the message from stdin
-    message = sys.stdin.buffer.read()
-    print_debug(f"Read {len(message)} bytes from stdin...")
+    if message_path is not None:
+        # Map the file instead of reading it, pages are loaded as they are sent
+        with open(message_path, "rb") as f:
+            try:
+                message = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                message = b""  # Empty files can't be mapped
+        print_debug(f"Mapped {len(message)} bytes from {message_path}...")
+    else:
+        # Read the message from stdin
+        message = sys.stdin.buffer.read()
+        print_debug(f"Read {len(message)} bytes from stdin...")
 
     # --- Conection establishment (START phase) ---
+    if profiler:
+        profiler.phase("handshake")
     # Create a START packet with type=0, seq_num=0
     seq_num = 0  # Starting sequence number
 
-    # Create the header
-    start_header = PacketHeader(type=0, seq_num=seq_num, length=0)
-
-    # Create the packet(header only, no data)
-    start_packet = build_packet(start_header)
+    # Propose our maximum packet size, optionally from the path MTU
+    if probe_mtu:
+        path_mtu = probe_path_mtu(receiver_ip, receiver_port)
+        packet_size = min(packet_size, path_mtu)
+        print_debug(f"Path MTU probe allows {path_mtu} byte packets, proposing {packet_size}")
+    packet_size = min(packet_size, MAX_PACKET_SIZE)
+    # ACKs are received into recv_size bytes: enough for our packets and for a
+    # START ACK with every option or a DATA ACK with its window, however small
+    # the packet size
+    recv_size = max(packet_size, HEADER_SIZE + START_OPTIONS_SIZE, HEADER_SIZE + ACK_WINDOW_SIZE)
+    if resume:
+        # Identify the message so the receiver can tell if its checkpoint belongs to it
+        message_size = len(message)
+        message_crc = 0
+        # In chunks, releasing each one so the whole file is never resident at once
+        for offset in range(0, message_size, RELEASE_CHUNK_SIZE):
+            message_crc = zlib.crc32(message[offset : offset + RELEASE_CHUNK_SIZE], message_crc)
+            release_pages(message, offset, offset + RELEASE_CHUNK_SIZE)
+    else:
+        message_size = message_crc = 0
+    options = pack_options(
+        packet_size=packet_size,
+        fec_block=fec_block,
+        codec=codec,
+        message_size=message_size,
+        message_crc=message_crc,
+    )
+
+    # Create the packet(header + proposed options)
+    start_packet = build_header(0, seq_num, options) + options
 
     # Send the START packet
     s.sendto(start_packet, (receiver_ip, receiver_port))
+    start_sent = time.time()
     print_debug(f"Send START packet")
 
     # Wait for acknowledgment (ACK) from receiver
@@ -35,40 +88,85 @@ def sender(receiver_ip, receiver_port, window_size):
     while not start_acked:
         try:
             # Try to receive an ACK
-            data, addr = s.recvfrom(1472)  # Max UDP payload size
+            data, addr = s.recvfrom(recv_size)
 
-            # Parse the received packet
-            header = PacketHeader(data)
+            # Parse the received packet, corrupted ones are ignored
+            header = parse_checked_header(data)
 
             # Check if it's an ACK for our START
             if (
-                header.type == 3 and header.seq_num == 1
+                header is not None and header.type == 3 and header.seq_num == 1
             ):  # ACK with seq_num=1 means START was received
-                print_debug("Connection established!")
+                # The receiver answers with the packet size it accepts
+                accepted = unpack_options(data[HEADER_SIZE : HEADER_SIZE + header.length])
+                packet_size = min(packet_size, accepted["packet_size"])
+                # FEC is only on if the receiver echoed our block size back
+                if accepted["fec_block"] != fec_block:
+                    fec_block = 0
+                # Or if the negotiated packets leave no room for data next to the PARITY fields
+                if data_size(packet_size, fec_block) <= 0:
+                    fec_block = 0
+                # Same for compression, the receiver answers 0 for codecs it lacks
+                if accepted["codec"] != codec:
+                    codec = 0
+                # A receiver resuming a previous transfer tells us where to continue
+                resume_seq = accepted["resume_seq"] if resume else 1
+                receiver_window = accepted["receiver_window"]
+                print_debug(
+                    f"Connection established! Packet size {packet_size}, "
+                    f"FEC block {fec_block}, codec {codec}"
+                )
                 start_acked = True
                 seq_num = 1  # Next packet will be seq_num=1
+                handshake_rtt = time.time() - start_sent
 
         except socket.timeout:
             # If tiemout occurs, resend the START packet
             print_debug("Timeout waiting for START ACK, resending ...")
             s.sendto(start_packet, (receiver_ip, receiver_port))
+            start_sent = time.time()
+
+    # Size kernel buffers for a full window, or the bandwidth-delay product if larger
+    bdp = int(bandwidth * handshake_rtt)
+    granted = tune_socket_buffers(s, max(window_size * packet_size, bdp))
+    print_debug(
+        f"Handshake RTT {handshake_rtt * 1000:.2f} ms, BDP {bdp} bytes, "
+        f"socket buffers granted: receive {granted[0]}, send {granted[1]} bytes"
+    )
 
     # --- Data transfer phase ---
+    if profiler:
+        profiler.phase("transfer")
+    if codec:
+        # Send the compressed frame stream instead of the raw message
+        raw_size = len(message)
+        message = compress_stream(message, codec)
+        print_debug(f"Compressed {raw_size} bytes to {len(message)} with {CODECS[codec][0]}")
+
     # Split the message into chunks that fit in packets
-    # Maximum UDP payload is 1472 bytes, subtract header sieze (16 bytes)
-    MAX_DATA_SIZE = 1472 - 16
-    chunks = []
-    for i in range(0, len(message), MAX_DATA_SIZE):
-        chunks.append(message[i : i + MAX_DATA_SIZE])
+    # Negotiated packet size, minus header (16 bytes) and PARITY fields if FEC is on
+    MAX_DATA_SIZE = data_size(packet_size, fec_block)
+    # Chunks are memoryview slices of the message, payloads are never copied
+    message_view = memoryview(message)
+    num_chunks = (len(message) + MAX_DATA_SIZE - 1) // MAX_DATA_SIZE
 
-    print_debug(f"Message split into {len(chunks)} chunks")
+    def chunk(seq):
+        return message_view[(seq - 1) * MAX_DATA_SIZE : seq * MAX_DATA_SIZE]
 
-    # Set up sliding iwndow parameters
-    base = 1  # First unacknowledged packet
-    next_seq_num = 1  # Next packet to send
+    print_debug(f"Message split into {num_chunks} chunks")
 
-    # Buffer for storing sent packets (for potential retransmission)
-    buffer = {}
+    # Set up sliding iwndow parameters
+    base = resume_seq  # First unacknowledged packet
+    next_seq_num = resume_seq  # Next packet to send
+    if resume_seq > 1:
+        print_debug(f"Receiver already has packets up to {resume_seq - 1}, resuming")
+
+    # Headers of sent packets (for potential retransmission), the payload is
+    # sliced from the message again when resending
+    headers = {}
+    # Bytes of a mapped message before this offset were acknowledged and
+    # their pages released
+    released = 0
 
     # Set socket to non-blocking for parallel sending/receiving
     s.setblocking(False)
@@ -79,29 +177,40 @@ def sender(receiver_ip, receiver_port, window_size):
     timeout_duration = 0.5
 
     acknowledged = {} # For tracking if a seq_num is ACKed
-    
+
+    # Right edge of the receiver's window, from the START ACK if the receiver
+    # sent its window size, otherwise unknown until the first DATA ACK
+    receiver_edge = resume_seq + receiver_window if receiver_window else None
+
     # Continue until all packets are acknowledged
-    while base <= len(chunks):
-        # Send new packets that fit within the window
-        while next_seq_num < base + window_size and next_seq_num <= len(chunks):
+    while base <= num_chunks:
+        # Send new packets that fit within our window and the receiver's. Its edge is
+        # past base, since the receiver has everything before base in order.
+        send_limit = base + window_size
+        if receiver_edge is not None:
+            send_limit = min(send_limit, receiver_edge)
+        while next_seq_num < send_limit and next_seq_num <= num_chunks:
             # Get the chunk to send
-            chunk_index = next_seq_num - 1  # adjusted for 1-indexded sequence
-            data = chunks[chunk_index]
+            data = chunk(next_seq_num)
 
-            # Create DATA packet header
-            header = PacketHeader(type=2, seq_num=next_seq_num, length=len(data))
-            packet = build_packet(header, data)
-
-            # Store packet in buffer for potential retransmission
-            buffer[next_seq_num] = packet
+            # Create DATA header, store it for potential retransmission
+            headers[next_seq_num] = build_header(2, next_seq_num, data)
 
             # Mark this packet as unknowledged initially
             acknowledged[next_seq_num] = False
 
             # Send the packet
-            s.sendto(packet, (receiver_ip, receiver_port))
+            send_packet(s, (receiver_ip, receiver_port), headers[next_seq_num], data)
             print_debug(f"Sent DATA packet {next_seq_num}")
 
+            # After the last packet of a FEC block, send its parity once.
+            # PARITY is never ACKed or retransmitted and does not use the window.
+            if fec_block and (next_seq_num % fec_block == 0 or next_seq_num == num_chunks):
+                block_start = next_seq_num - (next_seq_num - 1) % fec_block
+                parity = build_parity([chunk(seq) for seq in range(block_start, next_seq_num + 1)])
+                s.sendto(build_header(4, block_start, parity) + parity, (receiver_ip, receiver_port))
+                print_debug(f"Sent PARITY packet for {block_start}-{next_seq_num}")
+
             # Start timer if this is the first packet in the window
             if not timer_active:
                 timer_start = time.time()
@@ -112,21 +221,41 @@ def sender(receiver_ip, receiver_port, window_size):
 
         # Try to receive ACKS (non-blocking)
         try:
-            data, addr = s.recvfrom(1472)
+            data, addr = s.recvfrom(recv_size)
 
-            # Parse header
-            header = PacketHeader(data)
+            # Parse header, a corrupted ACK could carry any seq_num or window edge
+            header = parse_checked_header(data)
 
             # Check if it's an ACK
-            if header.type == 3:
+            if header is None:
+                print_debug("Checksum error in ACK, ignoring")
+            elif header.type == 3:
                 print_debug(f"Received individual ACK for packet {header.seq_num}")
 
                 seq_ack = header.seq_num
-                acknowledged[seq_ack] = True
+                # Duplicate ACKs for packets below base must not add entries back
+                if seq_ack in acknowledged:
+                    acknowledged[seq_ack] = True
+
+                # ACKs that carry a payload advertise the receiver's window edge. It
+                # never moves back, so a smaller one comes from an ACK that was reordered.
+                if header.length == ACK_WINDOW_SIZE:
+                    edge = struct.unpack_from(ACK_WINDOW_FORMAT, data, HEADER_SIZE)[0]
+                    if receiver_edge is None or edge > receiver_edge:
+                        receiver_edge = edge
 
                 # Update base if the lowest ACKed packet has move forward
+                # and forget the packets it passed, so memory does not grow with the file
                 while base in acknowledged and acknowledged[base]:
+                    del acknowledged[base]
+                    del headers[base]
                     base += 1
+
+                # Pages of acknowledged data are never read again, drop them in
+                # batches so a mapped message keeps RSS flat
+                acked_bytes = (base - 1) * MAX_DATA_SIZE
+                if acked_bytes - released >= RELEASE_CHUNK_SIZE:
+                    released = release_pages(message, released, acked_bytes)
         except BlockingIOError:
             # No data available to receive
             pass
@@ -134,60 +263,168 @@ def sender(receiver_ip, receiver_port, window_size):
         if timer_active and (time.time() - timer_start > timeout_duration):
             print_debug("Timeout occured, resending unacknowledges packets")
 
-            # Resend all unacknowledged packets in the window
-            for seq in range(base, next_seq_num):
+            # Resend all unacknowledged packets in the window, except those the
+            # receiver would drop again for being past its window
+            resend_limit = next_seq_num
+            if receiver_edge is not None:
+                resend_limit = min(resend_limit, receiver_edge)
+            for seq in range(base, resend_limit):
                 if seq in acknowledged and not acknowledged[seq]:
-                    s.sendto(buffer[seq], (receiver_ip, receiver_port))
+                    send_packet(s, (receiver_ip, receiver_port), headers[seq], chunk(seq))
                     print_debug(f"Resent DATA packet {seq}")
 
             # Reset timer
             timer_start = time.time()
 
     # --- Connection termination (END phase)
+    if profiler:
+        profiler.phase("teardown")
     # Create END packet (type=1)
-    end_header = PacketHeader(type=1, seq_num=next_seq_num, length=0)
-    end_packet = build_packet(end_header)
+    end_packet = build_control_packet(1, next_seq_num)
 
     # Switch back to blocking socket with timeout
     s.setblocking(True)
     s.settimeout(0.5)
 
-    # Send END packet
-    s.sendto(end_packet, (receiver_ip, receiver_port))
-    print_debug(f"Sent END packet with seq_num {next_seq_num}")
-
-    # Wait for ACK for END packet or timeout after 500ms
-    end_time = time.time()
     end_acked = False
+    end_status = END_OK
+
+    # The receiver quits once it ACKs END, and a resuming receiver only checks
+    # the message on END, so resend it a few times if the ACK does not come
+    for attempt in range(END_ATTEMPTS):
+        # Send END packet
+        s.sendto(end_packet, (receiver_ip, receiver_port))
+        print_debug(f"Sent END packet with seq_num {next_seq_num}")
+
+        # Wait for ACK for END packet or timeout after 500ms
+        end_time = time.time()
+
+        while not end_acked and time.time() - end_time < 0.5:
+            try:
+                data, addr = s.recvfrom(recv_size)
+                header = parse_checked_header(data)
+
+                # Check if it's an ACK for our END packet
+                if header is not None and header.type == 3 and header.seq_num == next_seq_num + 1:
+                    print_debug("Received ACK for End packet, connection terminatited")
+                    # A resuming receiver tells us if the whole message did not verify
+                    if header.length == END_STATUS_SIZE:
+                        end_status = struct.unpack_from(END_STATUS_FORMAT, data, HEADER_SIZE)[0]
+                    end_acked = True
+                    break
+            except socket.timeout:
+                pass
+
+        if end_acked:
+            break
 
-    while not end_acked and time.time() - end_time < 0.5:
-        try:
-            data, addr = s.recvfrom(1472)
-            header = PacketHeader(data)
-
-            # Check if it's an ACK for our END packet
-            if header.type == 3 and header.seq_num == next_seq_num + 1:
-                print_debug("Received ACK for End packet, connection terminatited")
-                end_acked = True
-                break
-        except socket.timeout:
-            pass
-        
     if not end_acked:
         print(f"ACK for END timed out, terminating")
+    elif end_status == END_CRC_MISMATCH:
+        print("Receiver discarded the message, its CRC did not match. Run again to resend it")
+    elif end_status == END_INCOMPLETE:
+        print("Receiver is missing part of the message. Run again with --resume to finish it")
     s.close()
+    return end_status == END_OK
 
 
 def main():
     """Parse command-line arguments and call sender function"""
-    if len(sys.argv) != 4:
-        sys.exit(
-            "Usage: python sender.py [Receiver IP] [Receiver Port] [Window Size] < [message]"
+    codecs = {name: codec for codec, (name, _, _) in CODECS.items()}
+    parser = argparse.ArgumentParser(
+        usage="python sender.py [Receiver IP] [Receiver Port] [Window Size] [options] [--file PATH | < message]"
+    )
+    parser.add_argument("receiver_ip")
+    parser.add_argument("receiver_port", type=int)
+    parser.add_argument("window_size", type=int)
+    parser.add_argument(
+        "--packet-size",
+        type=int,
+        default=DEFAULT_PACKET_SIZE,
+        help="largest packet (header + data) to propose, capped by the receiver",
+    )
+    parser.add_argument(
+        "--probe-mtu",
+        action="store_true",
+        help="cap --packet-size at the largest packet the path carries without IP fragmentation",
+    )
+    parser.add_argument(
+        "--fec",
+        type=int,
+        default=0,
+        metavar="K",
+        help="send one XOR parity packet per K DATA packets (1/K overhead), 0 disables",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=list(codecs),
+        help="compress the message if the receiver supports this codec",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        help="send this file (memory mapped) instead of reading the message from stdin",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0,
+        metavar="MBPS",
+        help="expected path bandwidth in Mbit/s, sizes socket buffers from bandwidth x RTT",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue where a receiver running with --resume stopped last time",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sample"],
+        help="profile the run and write collapsed stacks and phase timings next to the input file",
+    )
+    parser.add_argument(
+        "--trace-malloc",
+        action="store_true",
+        help="with --profile, also record tracemalloc snapshots at START and END",
+    )
+    args = parser.parse_args()
+    if args.resume and args.compress:
+        parser.error("--resume can't be combined with --compress")
+    if args.packet_size <= HEADER_SIZE:
+        parser.error(f"--packet-size must be larger than the {HEADER_SIZE} byte header")
+    if args.fec and args.packet_size <= HEADER_SIZE + PARITY_HEADER_SIZE:
+        parser.error(
+            f"--packet-size must be larger than {HEADER_SIZE + PARITY_HEADER_SIZE} bytes with --fec"
+        )
+    profiler = None
+    if args.profile:
+        # Only load the profilers when asked for
+        from profiling import Profiler
+
+        profiler = Profiler(
+            args.profile, (args.file or "rtp") + ".sender", trace_memory=args.trace_malloc
+        )
+        profiler.start()
+    try:
+        delivered = sender(
+            args.receiver_ip,
+            args.receiver_port,
+            args.window_size,
+            packet_size=args.packet_size,
+            probe_mtu=args.probe_mtu,
+            fec_block=args.fec,
+            message_path=args.file,
+            codec=codecs.get(args.compress, 0),
+            bandwidth=args.bandwidth * 1e6 / 8,
+            resume=args.resume,
+            profiler=profiler,
         )
-    receiver_ip = sys.argv[1]
-    receiver_port = int(sys.argv[2])
-    window_size = int(sys.argv[3])
-    sender(receiver_ip, receiver_port, window_size)
+    finally:
+        if profiler is not None:
+            for path in profiler.stop():
+                print_debug(f"Wrote profile output {path}")
+    if not delivered:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,137 @@
 import binascii
+import importlib.util
+import mmap
+import os
+import socket
+import struct
 import sys
+import time
+import zlib
+from collections import namedtuple
+from functools import lru_cache
 
-from scapy.all import Packet
-from scapy.all import IntField
+# Only the modules above are loaded when sender.py/receiver.py start. scapy
+# alone takes most of a second to import, so PacketHeader is created on first
+# use (see __getattr__) and the hot path parses headers with struct instead.
 
-class PacketHeader(Packet):
-    name = "PacketHeader"
-    fields_desc = [
-        IntField("type", 0), # 0: START; 1: END; 2: DATA; 3: ACK
-        IntField("seq_num", 0),
-        IntField("length", 0),
-        IntField("checksum", 0),
-    ]
+def __getattr__(name):
+    if name == "PacketHeader":
+        global PacketHeader
+        from scapy.all import Packet
+        from scapy.all import IntField
+
+        class PacketHeader(Packet):
+            name = "PacketHeader"
+            fields_desc = [
+                IntField("type", 0), # 0: START; 1: END; 2: DATA; 3: ACK; 4: PARITY
+                IntField("seq_num", 0),
+                IntField("length", 0),
+                IntField("checksum", 0),
+            ]
+
+        return PacketHeader
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Same wire layout as PacketHeader: type, seq_num, length, checksum
+HEADER_FORMAT = "!IIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+Header = namedtuple("Header", ["type", "seq_num", "length", "checksum"])
+
+# Ethernet frame (1500) - IP header (20) - UDP header (8)
+DEFAULT_PACKET_SIZE = 1472
+# Largest UDP payload over IPv4: 65535 - 20 - 8
+MAX_PACKET_SIZE = 65507
+
+# Options the sender proposes in the START payload and the receiver answers in
+# the START ACK payload, as (name, struct format, default). A peer that sends
+# fewer fields (e.g. an empty START) gets the defaults for the missing ones.
+START_OPTIONS = [
+    ("packet_size", "I", DEFAULT_PACKET_SIZE),
+    ("fec_block", "I", 0),  # DATA packets per parity packet, 0 disables FEC
+    ("codec", "I", 0),  # Payload compression, a key of CODECS or 0 for none
+    # Identify the message for resumable transfers, a size of 0 disables resuming
+    ("message_size", "Q", 0),
+    ("message_crc", "I", 0),
+    ("resume_seq", "I", 1),  # Set by the receiver: first seq_num the sender must send
+    # Set by the receiver: its window size, so the sender knows the window edge
+    # before the first DATA ACK. 0 if unknown.
+    ("receiver_window", "I", 0),
+]
+START_OPTIONS_SIZE = struct.calcsize("!" + "".join(fmt for _, fmt, _ in START_OPTIONS))
+
+# PARITY payload starts with the block's packet count and XOR of their lengths
+PARITY_FORMAT = "!II"
+PARITY_HEADER_SIZE = struct.calcsize(PARITY_FORMAT)
+
+def _lz4_compress(data):
+    import lz4.frame
+
+    return lz4.frame.compress(data)
+
+def _lz4_decompress(data):
+    import lz4.frame
+
+    return lz4.frame.decompress(data)
+
+# Compression codecs available here: id -> (name, compress, decompress)
+CODECS = {1: ("zlib", zlib.compress, zlib.decompress)}
+# lz4 is optional, only imported once a transfer uses it
+if importlib.util.find_spec("lz4") is not None:
+    CODECS[2] = ("lz4", _lz4_compress, _lz4_decompress)
+
+# Compressed messages are a stream of frames, each holding one block of the
+# message: flag (1: compressed, 0: stored raw) and payload length
+FRAME_FORMAT = "!BI"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_FORMAT)
+COMPRESS_BLOCK_SIZE = 64 * 1024
+# Only the start of each block is compressed first to estimate the ratio
+COMPRESS_SAMPLE_SIZE = 4 * 1024
+# Blocks that don't shrink below this ratio are stored raw
+COMPRESS_MIN_RATIO = 0.9
+
+# Linux values, the socket module does not export these names
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+IP_MTU = getattr(socket, "IP_MTU", 14)
+
+# DATA ACKs carry the right edge of the receiver's window as their payload:
+# the first seq_num it can't accept (its next in-order seq_num + window size)
+ACK_WINDOW_FORMAT = "!I"
+ACK_WINDOW_SIZE = struct.calcsize(ACK_WINDOW_FORMAT)
+
+# The END ACK of a resumable transfer that did not verify carries the reason
+# as its payload, a plain END ACK means the message arrived intact
+END_STATUS_FORMAT = "!I"
+END_STATUS_SIZE = struct.calcsize(END_STATUS_FORMAT)
+END_OK, END_INCOMPLETE, END_CRC_MISMATCH = 0, 1, 2
+# Times the sender sends END before giving up on its ACK
+END_ATTEMPTS = 3
+
+# Preallocated DATA ACK, only seq_num, window and checksum change between ACKs
+_ack_template = bytearray(
+    struct.pack(HEADER_FORMAT, 3, 0, ACK_WINDOW_SIZE, 0) + struct.pack(ACK_WINDOW_FORMAT, 0)
+)
+# CRC of the type field, which is the same for every ACK
+_ack_crc_prefix = binascii.crc32(_ack_template[:4])
+
+def parse_header(pkt):
+    """Header fields of a serialized packet, like PacketHeader without scapy"""
+    return Header._make(struct.unpack_from(HEADER_FORMAT, pkt))
+
+def packet_checksum(pkt, data):
+    """CRC of a received packet as the sender computed it, with checksum zeroed"""
+    crc = binascii.crc32(pkt[:12])
+    crc = binascii.crc32(b"\0\0\0\0", crc)
+    return binascii.crc32(data, crc) & 0xffffffff
+
+def parse_checked_header(pkt):
+    """Header of a received packet, or None if it is truncated or fails its checksum"""
+    if len(pkt) < HEADER_SIZE:
+        return None
+    header = parse_header(pkt)
+    if header.checksum != packet_checksum(pkt, pkt[HEADER_SIZE : HEADER_SIZE + header.length]):
+        return None
+    return header
 
 def compute_checksum(pkt):
     return binascii.crc32(bytes(pkt)) & 0xffffffff
@@ -22,9 +142,349 @@ def build_packet(header, data=b""):
     header.checksum = compute_checksum(pkt_bytes)
     return bytes(header) + data
 
-def create_ack(seq_num, ack_type=3):
-    ack_header = PacketHeader(type=ack_type, seq_num=seq_num, length=0, checksum=0)
-    return build_packet(ack_header)
+def build_header(pkt_type, seq_num, data=b""):
+    """Serialize a header for data without going through scapy"""
+    header = struct.pack(HEADER_FORMAT, pkt_type, seq_num, len(data), 0)
+    # Continue the header CRC over the payload instead of concatenating first
+    checksum = binascii.crc32(data, binascii.crc32(header)) & 0xffffffff
+    return header[:12] + struct.pack("!I", checksum)
+
+def send_packet(sock, address, header, data):
+    """Send header and data as one datagram without concatenating them"""
+    if hasattr(sock, "sendmsg"):
+        sock.sendmsg([header, data], [], 0, address)
+    else:
+        sock.sendto(header + bytes(data), address)
+
+@lru_cache(maxsize=16)
+def build_control_packet(pkt_type, seq_num):
+    """START/END/ACK packets only depend on type and seq_num, so cache them"""
+    return build_header(pkt_type, seq_num)
+
+def create_ack(seq_num, ack_type=3, data=b"", window=None):
+    if data:
+        return build_header(ack_type, seq_num, data) + data
+    if ack_type != 3 or window is None:
+        return build_control_packet(ack_type, seq_num)
+    # Fill in the template in place, starting from the precomputed type CRC
+    struct.pack_into("!IIII", _ack_template, 4, seq_num, ACK_WINDOW_SIZE, 0, window)
+    checksum = binascii.crc32(memoryview(_ack_template)[4:], _ack_crc_prefix)
+    struct.pack_into("!I", _ack_template, 12, checksum & 0xffffffff)
+    return bytes(_ack_template)
+
+def tune_socket_buffers(sock, size):
+    """Ask the kernel for send and receive buffers of at least size bytes.
+
+    Buffers already larger than size (e.g. the system default when packets
+    are small) are left alone. Returns the (receive, send) sizes actually
+    granted, which the kernel may cap (net.core.rmem_max/wmem_max) or double
+    for bookkeeping on Linux.
+    """
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        if sock.getsockopt(socket.SOL_SOCKET, option) >= size:
+            continue
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass  # Keep the default size
+    return (
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+    )
+
+def pack_options(**options):
+    """Serialize START options, missing ones take their default"""
+    return b"".join(
+        struct.pack("!" + fmt, options.get(name, default))
+        for name, fmt, default in START_OPTIONS
+    )
+
+def unpack_options(data):
+    """Parse START options, fields missing from data take their default"""
+    options = {}
+    offset = 0
+    for name, fmt, default in START_OPTIONS:
+        size = struct.calcsize("!" + fmt)
+        if offset + size <= len(data):
+            options[name] = struct.unpack_from("!" + fmt, data, offset)[0]
+        else:
+            options[name] = default
+        offset += size
+    return options
+
+def build_parity(chunks):
+    """XOR parity payload over a block of DATA payloads.
+
+    Shorter payloads are zero padded to the longest one; any single missing
+    payload can be rebuilt from the parity and the others with recover_chunk.
+    """
+    size = max(len(chunk) for chunk in chunks)
+    parity = 0
+    lengths = 0
+    for chunk in chunks:
+        # Shift instead of padding so the chunk is not copied
+        parity ^= int.from_bytes(chunk, "big") << (8 * (size - len(chunk)))
+        lengths ^= len(chunk)
+    return struct.pack(PARITY_FORMAT, len(chunks), lengths) + parity.to_bytes(size, "big")
+
+def recover_chunk(parity_payload, chunks):
+    """Rebuild the one payload missing from chunks using the block's parity"""
+    _, length = struct.unpack_from(PARITY_FORMAT, parity_payload)
+    size = len(parity_payload) - PARITY_HEADER_SIZE
+    missing = int.from_bytes(parity_payload[PARITY_HEADER_SIZE:], "big")
+    for chunk in chunks:
+        missing ^= int.from_bytes(chunk, "big") << (8 * (size - len(chunk)))
+        length ^= len(chunk)
+    return missing.to_bytes(size, "big")[:length]
+
+def data_size(packet_size, fec_block):
+    """Payload bytes per DATA packet for a negotiated packet size"""
+    size = packet_size - HEADER_SIZE
+    if fec_block:
+        # Leave room for the count and length fields of PARITY packets
+        size -= PARITY_HEADER_SIZE
+    return size
+
+# Sent bytes of a memory mapped message to release at once, see release_pages
+RELEASE_CHUNK_SIZE = 1 << 20
+
+def release_pages(message, start, end):
+    """Drop the pages of a memory mapped message between start and end from
+    this process, so RSS does not grow with the file. The data stays in the
+    page cache and is faulted back in if it is read again.
+
+    Returns the page aligned offset actually released up to. Messages that
+    are not mapped (stdin, compressed) are left alone.
+    """
+    end -= end % mmap.PAGESIZE
+    if isinstance(message, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED") and end > start:
+        message.madvise(mmap.MADV_DONTNEED, start, end - start)
+        return end
+    return start
+
+def compress_stream(message, codec):
+    """Frame message into COMPRESS_BLOCK_SIZE blocks compressed with codec.
+
+    Each block's compressibility is sampled first, so incompressible data is
+    stored raw without paying for a full compression.
+    """
+    _, compress, _ = CODECS[codec]
+    view = memoryview(message)
+    frames = []
+    for offset in range(0, len(view), COMPRESS_BLOCK_SIZE):
+        block = view[offset : offset + COMPRESS_BLOCK_SIZE]
+        sample = block[:COMPRESS_SAMPLE_SIZE]
+        data = None
+        if len(compress(sample)) < len(sample) * COMPRESS_MIN_RATIO:
+            data = compress(block)
+        if data is not None and len(data) < len(block) * COMPRESS_MIN_RATIO:
+            frames.append(struct.pack(FRAME_FORMAT, 1, len(data)))
+            frames.append(data)
+        else:
+            frames.append(struct.pack(FRAME_FORMAT, 0, len(block)))
+            frames.append(block)
+    return b"".join(frames)
+
+class StreamDecoder:
+    """Writes the message decoded from a compress_stream frame stream to out"""
+
+    def __init__(self, out, codec):
+        self.out = out
+        self.decompress = CODECS[codec][2]
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending += data
+        # Decode every complete frame, keep the rest for the next packet
+        offset = 0
+        while len(self.pending) - offset >= FRAME_HEADER_SIZE:
+            compressed, length = struct.unpack_from(FRAME_FORMAT, self.pending, offset)
+            start = offset + FRAME_HEADER_SIZE
+            if len(self.pending) - start < length:
+                break
+            frame = self.pending[start : start + length]
+            self.out.write(self.decompress(frame) if compressed else frame)
+            offset = start + length
+        del self.pending[:offset]
+
+    def flush(self):
+        self.out.flush()
+
+# Seconds between checkpoint saves of a resumable transfer
+CHECKPOINT_INTERVAL = 1.0
+
+class Checkpoint:
+    """Receiver progress of a resumable transfer into an output file.
+
+    Every DATA payload is written straight to its place in the file. The
+    checkpoint records the next in-order seq_num, a bitmap of the out-of-order
+    packets already written and a running CRC of the in-order bytes. save()
+    replaces <output>.ckpt atomically.
+    """
+
+    FORMAT = "!QIIII"  # message_size, message_crc, data_size, expected_seq_num, content_crc
+
+    def __init__(self, path, message_size, message_crc, data_size):
+        self.path = path + ".ckpt"
+        self.message_size = message_size
+        self.message_crc = message_crc
+        self.data_size = data_size
+        self.expected_seq_num = 1
+        self.content_crc = 0
+        self.out_of_order = set()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    @classmethod
+    def open(cls, path, message_size, message_crc, data_size, window_size):
+        """Continue a checkpointed transfer of the same message into path, or start over.
+
+        Out-of-order packets beyond window_size are forgotten, a run with a
+        smaller window than the one that saved the checkpoint resends them.
+        The checkpoint is only trusted if the output file still holds every
+        packet it claims and the in-order part matches its CRC.
+        """
+        checkpoint = cls(path, message_size, message_crc, data_size)
+        try:
+            with open(checkpoint.path, "rb") as f:
+                saved = f.read()
+        except FileNotFoundError:
+            saved = b""
+
+        size = struct.calcsize(cls.FORMAT)
+        if len(saved) >= size and struct.unpack_from(cls.FORMAT, saved)[:3] == (
+            message_size,
+            message_crc,
+            data_size,
+        ):
+            _, _, _, expected, content_crc = struct.unpack_from(cls.FORMAT, saved)
+            # Bit i of the bitmap is set if packet expected + 1 + i is on disk
+            bitmap = saved[size:]
+            span = min(len(bitmap) * 8, window_size - 1)
+            out_of_order = {
+                expected + 1 + i for i in range(span) if bitmap[i // 8] >> (i % 8) & 1
+            }
+            in_order_size = (expected - 1) * data_size
+            needed = max(
+                [in_order_size] + [min(seq * data_size, message_size) for seq in out_of_order]
+            )
+            if (
+                os.fstat(checkpoint.fd).st_size >= needed
+                and checkpoint.file_crc(in_order_size) == content_crc
+            ):
+                checkpoint.expected_seq_num = expected
+                checkpoint.content_crc = content_crc
+                checkpoint.out_of_order = out_of_order
+                return checkpoint
+
+        # Different message, no checkpoint or an output file that was truncated
+        # or changed since, the file content is useless
+        os.ftruncate(checkpoint.fd, 0)
+        return checkpoint
+
+    def file_crc(self, length):
+        """CRC of the first length bytes of the output file, read a MiB at a time"""
+        crc = 0
+        for offset in range(0, length, 1 << 20):
+            crc = zlib.crc32(os.pread(self.fd, min(1 << 20, length - offset), offset), crc)
+        return crc
+
+    def write(self, seq_num, msg):
+        """Write a DATA payload to its place in the file, ignoring duplicates"""
+        if seq_num < self.expected_seq_num or seq_num in self.out_of_order:
+            return
+        os.pwrite(self.fd, msg, (seq_num - 1) * self.data_size)
+        if seq_num != self.expected_seq_num:
+            self.out_of_order.add(seq_num)
+            return
+
+        self.content_crc = zlib.crc32(msg, self.content_crc)
+        self.expected_seq_num += 1
+        while self.expected_seq_num in self.out_of_order:
+            # Read packets written out of order back to extend the running CRC
+            self.out_of_order.remove(self.expected_seq_num)
+            msg = os.pread(self.fd, self.data_size, (self.expected_seq_num - 1) * self.data_size)
+            self.content_crc = zlib.crc32(msg, self.content_crc)
+            self.expected_seq_num += 1
+
+    def save(self):
+        # The data must be on disk before the checkpoint claims it is
+        os.fsync(self.fd)
+        span = max(self.out_of_order, default=self.expected_seq_num) - self.expected_seq_num
+        bitmap = bytearray((span + 7) // 8)
+        for seq_num in self.out_of_order:
+            i = seq_num - self.expected_seq_num - 1
+            bitmap[i // 8] |= 1 << (i % 8)
+        header = struct.pack(
+            self.FORMAT,
+            self.message_size,
+            self.message_crc,
+            self.data_size,
+            self.expected_seq_num,
+            self.content_crc,
+        )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header + bitmap)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def complete(self):
+        """True once every byte of the message has been written in order"""
+        return (self.expected_seq_num - 1) * self.data_size >= self.message_size
+
+    def finish(self):
+        """Verify the whole message against the sender's CRC, return True if it matches.
+
+        The checkpoint file is removed on success. A complete message with the
+        wrong CRC can't be repaired by resuming, so the output is truncated and
+        the checkpoint removed as well, the next run sends everything again.
+        An incomplete message keeps its checkpoint.
+        """
+        if not self.complete():
+            self.close()
+            return False
+        matches = self.content_crc == self.message_crc
+        if not matches:
+            os.ftruncate(self.fd, 0)
+        os.close(self.fd)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        return matches
+
+    def close(self):
+        """Save progress so a restarted transfer can continue from here"""
+        self.save()
+        os.close(self.fd)
+
+def probe_path_mtu(ip, port, rounds=3):
+    """Find the largest packet that reaches ip:port without IP fragmentation.
+
+    Sends don't-fragment probes sized to the kernel's path MTU estimate until it
+    stops shrinking (ICMP "fragmentation needed" lowers it). Probes carry a bad
+    checksum so receivers drop them. Falls back to DEFAULT_PACKET_SIZE where
+    path MTU discovery is not available.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        s.connect((ip, port))
+        mtu = s.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        for _ in range(rounds):
+            try:
+                s.send(b"\xff" * min(mtu - 28, MAX_PACKET_SIZE))
+            except OSError:
+                pass  # EMSGSIZE, the estimate was already lowered
+            time.sleep(0.05)
+            new_mtu = s.getsockopt(socket.IPPROTO_IP, IP_MTU)
+            if new_mtu == mtu:
+                break
+            mtu = new_mtu
+    except OSError:
+        return DEFAULT_PACKET_SIZE
+    finally:
+        s.close()
+    return min(mtu - 28, MAX_PACKET_SIZE)
 
 def print_debug(msg):
     print(msg, file=sys.stderr)
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+""" Check that sender.py and receiver.py start within an import-time budget. """
+""" Usage: python3 import_budget.py [folder] [budget in ms] """
+
+MODULES = ["sender", "receiver"]
+# Modules that must only be loaded on demand
+FORBIDDEN = ["scapy", "lz4", "cProfile", "tracemalloc"]
+RUNS = 3
+
+
+def import_times(folder, module):
+    """Cumulative import time in microseconds of every module loaded by `import module`"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=folder,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../RTP-opt"
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    failed = False
+
+    for module in MODULES:
+        # Best of a few runs, the first one may pay for a cold disk cache
+        runs = [import_times(folder, module) for _ in range(RUNS)]
+        best_ms = min(times[module] for times in runs) / 1000
+        forbidden = sorted({name.split(".")[0] for name in runs[0]} & set(FORBIDDEN))
+
+        if forbidden:
+            print("FAILURE: %s imports %s at startup" % (module, ", ".join(forbidden)))
+            failed = True
+        if best_ms > budget_ms:
+            print("FAILURE: importing %s took %.1f ms, budget is %.1f ms" % (module, best_ms, budget_ms))
+            failed = True
+        else:
+            print("%s: %.1f ms (budget %.1f ms)" % (module, best_ms, budget_ms))
+
+    if failed:
+        sys.exit(1)
+    print("\nSUCCESS: import times are within budget\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,10 @@ import signal
 from scapy.all import Packet
 from scapy.all import IntField
 
+import rtptrace
+
 """ Implemented in Python 3.7.2 """
-""" Usage: python3 proxy <sender addr> <sender port> <receiver addr> <receiver port> <error type>"""
+""" Usage: python3 proxy <sender addr> <sender port> <receiver addr> <receiver port> <error type> [trace file]"""
 
 class PacketHeader(Packet):
     name = "PacketHeader"
@@ -18,8 +20,9 @@ class PacketHeader(Packet):
         IntField("checksum", 0),
     ]
 def get_seq_num(pkt):
-    if len(pkt) > 1500:
-        print ('Error! Packet size exceeds 1500')
+    # Largest UDP payload over IPv4, jumbo packets up to this size are fine
+    if len(pkt) > 65507:
+        print ('Error! Packet size exceeds 65507')
     pkt_header = PacketHeader(pkt[:16])
     type = 'START/END'
     if pkt_header.type == 2:
@@ -37,12 +40,21 @@ def main():
     sender_port = [0]
     options = sys.argv[5] #error types
     start_stage = 0
+    # Optionally record every datagram and what happened to it, see rtptrace.py
+    trace = rtptrace.TraceWriter(sys.argv[6], time.time) if len(sys.argv) > 6 else None
 
     def run(from_addr, from_port, from_socket, to_addr, to_port, to_socket, start_stage):
+        direction = rtptrace.TO_RECEIVER if to_port == receiver_port else rtptrace.TO_SENDER
+
+        def record(fate, pkt, extra=0, group=0):
+            if trace is not None:
+                trace.write(direction, fate, pkt, extra, group)
+
         def delay():
             """ Delay a packet by 0.02 seconds. """
-            pkt, address = from_socket.recvfrom(2048)
+            pkt, address = from_socket.recvfrom(65535)
             print ("Got it: Delay. %s: %d" % get_seq_num(pkt))
+            record(rtptrace.DELAYED, pkt, 400)
             time.sleep(0.4)
             to_socket.sendto(pkt, (to_addr, to_port))
             pass
@@ -54,39 +66,46 @@ def main():
 
             for i in range(0, num):
                 try:
-                    pkt, address = from_socket.recvfrom(2048)
+                    pkt, address = from_socket.recvfrom(65535)
                     print ("Got it: Reorder. %s: %d" % get_seq_num(pkt))
                     packet_list.append(pkt)
                 except socket.error:
                     break
 
-            random.shuffle(packet_list)
+            order = list(range(len(packet_list)))
+            random.shuffle(order)
+            # Record in arrival order, with the position each packet goes out at
+            for i, pkt in enumerate(packet_list):
+                record(rtptrace.REORDERED, pkt, order.index(i), len(packet_list))
 
-            for pkt in packet_list:
-                to_socket.sendto(pkt, (to_addr, to_port))
+            for i in order:
+                to_socket.sendto(packet_list[i], (to_addr, to_port))
             pass
 
         def drop():
             """ Drop the next available packet. """
-            pkt, address = from_socket.recvfrom(2048)
+            pkt, address = from_socket.recvfrom(65535)
             print ("Got it: Drop. %s: %d" % get_seq_num(pkt))
+            record(rtptrace.DROPPED, pkt)
             return
 
         def jam():
             """ Randomly change a character from the packet to a. """
-            pkt, address = from_socket.recvfrom(2048)
+            pkt, address = from_socket.recvfrom(65535)
             i = random.randint(0, len(pkt) - 1)
+            record(rtptrace.CORRUPTED, pkt, i)
             pkt = pkt[:i] + b'a' + pkt[i:]
             print ("Got it: Jam. %s: %d" % get_seq_num(pkt))
             to_socket.sendto(pkt, (to_addr, to_port))
             pass
 
         if start_stage < 10 or random.randint(1, 100) > 20:
-            pkt, address = from_socket.recvfrom(2048, socket.MSG_DONTWAIT)
+            pkt, address = from_socket.recvfrom(65535, socket.MSG_DONTWAIT)
             if address[1] != receiver_port and address[1] != bind_port:
                 sender_port.pop(0)
                 sender_port.append(address[1])
             print ("Got it: No messing. %s: %d" % get_seq_num(pkt))
+            record(rtptrace.FORWARDED, pkt)
 
             to_socket.sendto(pkt, (to_addr, to_port))
         else:
@@ -0,0 +1,106 @@
+import select
+import signal
+import socket
+import sys
+import time
+
+import rtptrace
+
+""" Replays the impairments recorded in a proxy trace against a new sender/receiver. """
+""" Usage: python3 replay.py <sender addr> <sender port> <receiver addr> <receiver port> <trace file> [output trace]"""
+""" Works like proxy.py, but the n-th datagram in each direction gets the fate the n-th """
+""" datagram in that direction got in the trace. Datagrams beyond the trace are forwarded. """
+
+# Like the proxy, give up waiting for the rest of a reorder group after 0.1 seconds
+REORDER_TIMEOUT = 0.1
+
+
+def main():
+    bind_addr = sys.argv[1]
+    bind_port = int(sys.argv[2])
+    receiver_addr = sys.argv[3]
+    receiver_port = int(sys.argv[4])
+    records = rtptrace.read_trace(sys.argv[5])
+    trace = rtptrace.TraceWriter(sys.argv[6], time.time) if len(sys.argv) > 6 else None
+
+    directions = [rtptrace.TO_RECEIVER, rtptrace.TO_SENDER]
+    # Fates for each direction, in the order the datagrams arrived
+    pattern = {d: [r for r in records if r.direction == d] for d in directions}
+    counters = {d: 0 for d in directions}
+    held = {d: [] for d in directions}  # (position, packet) of an incomplete reorder group
+
+    sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender_socket.bind((bind_addr, bind_port))
+    destinations = {rtptrace.TO_RECEIVER: (receiver_socket, (receiver_addr, receiver_port))}
+
+    def send(direction, pkt):
+        out_socket, address = destinations[direction]
+        out_socket.sendto(pkt, address)
+
+    def flush_held(direction):
+        for _, pkt in sorted(held[direction], key=lambda item: item[0]):
+            send(direction, pkt)
+        held[direction] = []
+
+    # Background jobs ignore SIGINT, so also stop cleanly on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("Replaying %d recorded datagrams" % len(records))
+    try:
+        while True:
+            readable, _, _ = select.select([sender_socket, receiver_socket], [], [], REORDER_TIMEOUT)
+            if not readable:
+                for direction in directions:
+                    flush_held(direction)
+                continue
+
+            for sock in readable:
+                pkt, address = sock.recvfrom(65535)
+                if sock is sender_socket:
+                    direction = rtptrace.TO_RECEIVER
+                    # Replies go back to wherever the sender sends from
+                    destinations[rtptrace.TO_SENDER] = (sender_socket, address)
+                elif rtptrace.TO_SENDER in destinations:
+                    direction = rtptrace.TO_SENDER
+                else:
+                    continue
+
+                n = counters[direction]
+                counters[direction] += 1
+                if n < len(pattern[direction]):
+                    record = pattern[direction][n]
+                    fate, extra, group = record.fate, record.extra, record.group
+                else:
+                    fate, extra, group = rtptrace.FORWARDED, 0, 0
+                if trace is not None:
+                    trace.write(direction, fate, pkt, extra, group)
+
+                if fate == rtptrace.DROPPED:
+                    continue
+                elif fate == rtptrace.DELAYED:
+                    # The proxy blocks while delaying, so block here too
+                    time.sleep(extra / 1000)
+                    send(direction, pkt)
+                elif fate == rtptrace.REORDERED:
+                    held[direction].append((extra, pkt))
+                    if len(held[direction]) >= group:
+                        flush_held(direction)
+                elif fate == rtptrace.CORRUPTED:
+                    i = min(extra, len(pkt) - 1)
+                    send(direction, pkt[:i] + b"a" + pkt[i:])
+                else:
+                    send(direction, pkt)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if trace is not None:
+            trace.close()
+        print("Replayed %d datagrams to the receiver and %d to the sender" % (
+            counters[rtptrace.TO_RECEIVER],
+            counters[rtptrace.TO_SENDER],
+        ))
+
+
+if __name__ == "__main__":
+    main()
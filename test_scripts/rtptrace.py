@@ -0,0 +1,129 @@
+import struct
+import sys
+from collections import namedtuple
+
+""" Binary packet traces written by proxy.py and replay.py. """
+""" Usage: python3 rtptrace.py <trace file> [bucket seconds] prints a summary """
+
+# File starts with a magic and a version, followed by fixed size records
+MAGIC = b"RTPT"
+VERSION = 1
+FILE_HEADER = struct.Struct("!4sB")
+
+# time since trace start, direction, fate, packet type, reorder group size,
+# seq_num, length field, datagram size, extra (see fates below)
+RECORD = struct.Struct("!dBBBBIIIi")
+Record = namedtuple(
+    "Record", ["time", "direction", "fate", "type", "group", "seq_num", "length", "size", "extra"]
+)
+
+# Directions
+TO_RECEIVER = 0
+TO_SENDER = 1
+
+# Fates, and what extra holds for them
+FORWARDED = 0
+DROPPED = 1
+DELAYED = 2  # extra: delay in ms
+REORDERED = 3  # extra: position the packet was sent out at within its group
+CORRUPTED = 4  # extra: index of the inserted byte
+FATES = ["forwarded", "dropped", "delayed", "reordered", "corrupted"]
+
+TYPES = {0: "START", 1: "END", 2: "DATA", 3: "ACK", 4: "PARITY"}
+
+
+class TraceWriter:
+    def __init__(self, path, clock):
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.clock = clock
+        self.start = clock()
+
+    def write(self, direction, fate, pkt, extra=0, group=0):
+        """Record one datagram, pkt is the datagram as received"""
+        if len(pkt) >= 16:
+            pkt_type, seq_num, length, _ = struct.unpack_from("!IIII", pkt)
+        else:
+            pkt_type, seq_num, length = 255, 0, 0
+        record = RECORD.pack(
+            self.clock() - self.start,
+            direction,
+            fate,
+            min(pkt_type, 255),
+            group,
+            seq_num,
+            length,
+            len(pkt),
+            extra,
+        )
+        self.file.write(record)
+        # The proxy is usually stopped with a signal, don't lose buffered records
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        sys.exit("%s is not a version %d RTP trace" % (path, VERSION))
+    return [Record._make(fields) for fields in RECORD.iter_unpack(data[FILE_HEADER.size :])]
+
+
+def summarize(records, bucket=0.5):
+    """Fate counts, DATA goodput and a per-bucket retransmission timeline"""
+    lines = []
+    duration = records[-1].time if records else 0
+    counts = [0] * len(FATES)
+    for record in records:
+        counts[record.fate] += 1
+    lines.append(
+        "%.3f s, %d datagrams: %s"
+        % (duration, len(records), ", ".join("%d %s" % (n, fate) for n, fate in zip(counts, FATES)))
+    )
+
+    # Goodput counts each DATA seq_num once, the first time it gets through intact
+    sent = set()
+    delivered = set()
+    timeline = {}  # bucket -> [new DATA, retransmitted DATA, delivered bytes]
+    for record in records:
+        if record.direction != TO_RECEIVER or record.type != 2:
+            continue
+        row = timeline.setdefault(int(record.time / bucket), [0, 0, 0])
+        if record.seq_num in sent:
+            row[1] += 1
+        else:
+            row[0] += 1
+            sent.add(record.seq_num)
+        if record.fate not in (DROPPED, CORRUPTED) and record.seq_num not in delivered:
+            delivered.add(record.seq_num)
+            row[2] += record.length
+
+    total = sum(row[2] for row in timeline.values())
+    retransmissions = sum(row[1] for row in timeline.values())
+    lines.append(
+        "DATA: %d packets, %d retransmissions, %d bytes delivered, goodput %.1f KB/s"
+        % (len(sent), retransmissions, total, total / duration / 1000 if duration else 0)
+    )
+    lines.append("")
+    lines.append("time_s     new    retx  goodput_KB/s")
+    for i in range(max(timeline) + 1 if timeline else 0):
+        new, retx, delivered_bytes = timeline.get(i, [0, 0, 0])
+        lines.append(
+            "%6.1f  %6d  %6d  %12.1f" % (i * bucket, new, retx, delivered_bytes / bucket / 1000)
+        )
+    return "\n".join(lines)
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python3 rtptrace.py <trace file> [bucket seconds]")
+    bucket = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    print(summarize(read_trace(sys.argv[1]), bucket))
+
+
+if __name__ == "__main__":
+    main()
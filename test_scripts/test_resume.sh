@@ -0,0 +1,92 @@
+PYTHON_PATH=$(which python3)
+FOLDER=../RTP-opt
+PORT_RECV=40001
+PORT_SEND=50001
+WINDOW_SIZE=16
+ERROR_TYPE="0123"
+MESSAGE=resume_message.txt
+OUTPUT=resume_output.txt
+SENDER_LOG=resume_sender.log
+RECEIVER_LOG=resume_receiver.log
+
+# Kill-and-resume test for --resume. A transfer is interrupted once with only
+# the sender dying (the receiver continues with the restarted sender) and once
+# with both dying (both restart from the receiver's checkpoint).
+
+function start_receiver {
+  $PYTHON_PATH $FOLDER/receiver.py $PORT_RECV $WINDOW_SIZE --output $OUTPUT --resume 2>> $RECEIVER_LOG &
+  RECEIVER_PID=$!
+  sleep 1
+}
+
+function start_sender {
+  $PYTHON_PATH $FOLDER/sender.py localhost $PORT_SEND $WINDOW_SIZE --file $MESSAGE --resume > /dev/null 2>&1 &
+  SENDER_PID=$!
+}
+
+# Wait until the receiver saved a checkpoint and a bit more data arrived
+function wait_for_checkpoint {
+  for i in $(seq 1 100); do
+    if [ -f $OUTPUT.ckpt ]; then
+      sleep 2
+      return 0
+    fi
+    sleep 0.2
+  done
+  printf "\nFAILURE: no checkpoint was saved\n\n"
+  exit 1
+}
+
+# Send the rest of the message with a new sender, both ends must report success
+function finish_transfer {
+  timeout 120 $PYTHON_PATH $FOLDER/sender.py localhost $PORT_SEND $WINDOW_SIZE --file $MESSAGE --resume > /dev/null 2> $SENDER_LOG
+  SENDER_STATUS=$?
+  wait $RECEIVER_PID
+  RECEIVER_STATUS=$?
+  if [ $SENDER_STATUS -ne 0 ] || [ $RECEIVER_STATUS -ne 0 ]; then
+    printf "\nFAILURE: sender exited with $SENDER_STATUS, receiver with $RECEIVER_STATUS\n\n"
+    exit 1
+  fi
+  if ! grep -q "Receiver already has packets" $SENDER_LOG; then
+    printf "\nFAILURE: the restarted sender did not resume, it sent everything again\n\n"
+    exit 1
+  fi
+  if [ -f $OUTPUT.ckpt ]; then
+    printf "\nFAILURE: checkpoint left behind after a complete transfer\n\n"
+    exit 1
+  fi
+  bash compare.sh $OUTPUT $MESSAGE
+  if ! diff -q $OUTPUT $MESSAGE > /dev/null; then
+    exit 1
+  fi
+}
+
+head -c 100000 /dev/urandom | base64 > $MESSAGE
+rm -f $OUTPUT $OUTPUT.ckpt $RECEIVER_LOG
+
+$PYTHON_PATH proxy.py localhost $PORT_SEND localhost $PORT_RECV $ERROR_TYPE > /dev/null &
+PROXY_PID=$!
+# Don't leave anything running, a leftover receiver would hold the port
+trap 'kill $PROXY_PID $RECEIVER_PID $SENDER_PID 2> /dev/null' EXIT
+sleep 1
+
+echo "Case 1: the sender dies, the receiver stays up"
+start_receiver
+start_sender
+wait_for_checkpoint
+kill -9 $SENDER_PID
+wait $SENDER_PID 2> /dev/null
+echo "Killed sender $SENDER_PID, restarting it"
+finish_transfer
+
+rm -f $OUTPUT
+
+echo "Case 2: sender and receiver die"
+start_receiver
+start_sender
+wait_for_checkpoint
+kill -9 $SENDER_PID $RECEIVER_PID
+wait $SENDER_PID $RECEIVER_PID 2> /dev/null
+echo "Killed sender $SENDER_PID and receiver $RECEIVER_PID, restarting both"
+start_receiver
+finish_transfer